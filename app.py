@@ -1,68 +1,460 @@
-from flask import Flask, render_template, request, jsonify, send_from_directory
+from flask import Flask, render_template, request, jsonify, send_from_directory, Response
 import os
 import subprocess
 import signal
-from threading import Lock
+import struct
+import math
+import bisect
+import ctypes
+from threading import Lock, Thread
+from urllib.parse import quote
 import wave
 import contextlib
 import tempfile
 import uuid
 import time
+from typing import Optional
 
 app = Flask(__name__)
-app.config['RECORDINGS_DIR'] = os.path.join(os.getcwd(), 'recordings')
+app.config['RECORDINGS_DIR'] = os.environ.get('RPI_RECORDINGS_DIR') or os.path.join(os.getcwd(), 'recordings')
+# Let a front-end web server stream downloads with sendfile(2):
+# RPI_X_SENDFILE=1 for Apache/lighttpd (X-Sendfile), or
+# RPI_ACCEL_REDIRECT=/internal/recordings/ for an nginx internal location
+app.config['USE_X_SENDFILE'] = os.environ.get('RPI_X_SENDFILE') == '1'
+app.config['ACCEL_REDIRECT_PREFIX'] = os.environ.get('RPI_ACCEL_REDIRECT')
 if not os.path.exists(app.config['RECORDINGS_DIR']):
     os.makedirs(app.config['RECORDINGS_DIR'])
 
 # Store process info
-task = {
-    'process': None,
-    'mode': None,  # 'record' or 'play'
-    'temp_file': None,  # temporary file for seeking
-}
+class TaskState:
+    __slots__ = ('process', 'mode', 'temp_file', 'source', 'feeder', 'play_file')
+
+    def __init__(self):
+        self.process: Optional[subprocess.Popen] = None
+        self.mode: Optional[str] = None  # 'record', 'paused' or 'play'
+        self.temp_file: Optional[str] = None  # temporary file for seeking
+        self.source: Optional[subprocess.Popen] = None  # upstream process feeding 'process' (sox when seeking)
+        self.feeder: Optional[Thread] = None  # thread sendfile()ing a seeked WAV into 'process'
+        self.play_file: Optional[str] = None  # file being played, dropped from the page cache on stop
+
+task = TaskState()
 lock = Lock()
 
-# Helper: aggressively release audio device if lingering aplay processes exist
-def force_release_device(selected_device: str) -> None:
+# Explicit ALSA period/buffer sizes (frames) for predictable playback latency;
+# one pair shared by both devices
+PERIOD_FRAMES = int(os.environ.get('RPI_PERIOD', 1024))
+BUFFER_FRAMES = int(os.environ.get('RPI_BUFFER', 4 * PERIOD_FRAMES))
+PLAY_BUFFER_ARGS = ('--period-size', str(PERIOD_FRAMES), '--buffer-size', str(BUFFER_FRAMES))
+
+# Capture wants headroom against overruns, not low latency: arecord keeps its
+# own (larger) defaults unless RPI_REC_PERIOD / RPI_REC_BUFFER are set
+RECORD_BUFFER_ARGS = ()
+if os.environ.get('RPI_REC_PERIOD'):
+    RECORD_BUFFER_ARGS += ('--period-size', str(int(os.environ['RPI_REC_PERIOD'])))
+if os.environ.get('RPI_REC_BUFFER'):
+    RECORD_BUFFER_ARGS += ('--buffer-size', str(int(os.environ['RPI_REC_BUFFER'])))
+
+# Command templates per device; the input/output file is appended per request
+RECORD_CMDS = {
+    'xr18': ('arecord', '-D', 'hw:3,0', '-f', 'S32_LE', '-c', '18', '-r', '48000', *RECORD_BUFFER_ARGS),
+    'x32': ('arecord', '-D', 'hw:3,0', '-f', 'S32_LE', '-c', '32', '-r', '48000', *RECORD_BUFFER_ARGS),
+}
+PLAY_CMDS = {
+    'xr18': ('aplay', '-D', 'hw:3,0', *PLAY_BUFFER_ARGS),
+    'x32': ('aplay', '-D', 'hw:XUSB,0', '-c', '32', '-r', '48000', '-f', 'S32_LE', *PLAY_BUFFER_ARGS),
+}
+
+# ALSA status of each device's playback substream ("closed" when free)
+PCM_STATUS = {
+    'xr18': '/proc/asound/card3/pcm0p/sub0/status',
+    'x32': '/proc/asound/XUSB/pcm0p/sub0/status',
+}
+
+# Helper: state of the playback substream ('closed', 'PREPARED', 'RUNNING', ...),
+# None when it can't be read
+def device_state(selected_device: str):
     try:
-        if selected_device == 'xr18':
-            pattern = 'hw:3,0'
-        elif selected_device == 'x32':
-            pattern = 'hw:XUSB,0'
-        else:
-            return
-        # Kill any aplay using the target device
-        subprocess.run(['bash', '-c', f'pkill -f "aplay -D {pattern}" || true'], check=False)
-        # Small wait to allow kernel to release the device nodes
-        time.sleep(0.2)
-    except Exception:
-        # Best-effort; ignore errors
+        with open(PCM_STATUS[selected_device]) as f:
+            status = f.read()
+    except (KeyError, OSError):
+        return None
+    if status.startswith('closed'):
+        return 'closed'
+    for line in status.splitlines():
+        if line.startswith('state:'):
+            return line.split(':', 1)[1].strip()
+    return 'OPEN'
+
+# Helper: whether the playback device is currently free
+def device_closed(selected_device: str) -> bool:
+    # Can't tell (None); let aplay report a busy device
+    return device_state(selected_device) in (None, 'closed')
+
+# Helper: poll until the playback device is released, returns False on timeout
+def wait_device_free(selected_device: str, timeout: float = 1.0) -> bool:
+    deadline = time.monotonic() + timeout
+    while not device_closed(selected_device):
+        if time.monotonic() >= deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+# Helper: wait until a just-started player has set up the device, returns False
+# if it exited. Falls back to the full timeout when the state can't be read
+def wait_player_started(proc, selected_device: str, timeout: float = 0.2) -> bool:
+    deadline = time.monotonic() + timeout
+    while proc.poll() is None and time.monotonic() < deadline:
+        # PREPARED/RUNNING only follow a successful open + hw_params
+        if device_state(selected_device) in ('PREPARED', 'RUNNING'):
+            break
+        time.sleep(0.01)
+    return proc.poll() is None
+
+# Helper: give the recorder realtime priority so the ALSA buffer doesn't overrun
+def raise_priority(pid: int) -> None:
+    try:
+        os.sched_setscheduler(pid, os.SCHED_FIFO, os.sched_param(50))
+        return
+    except (AttributeError, OSError) as e:
+        print(f"SCHED_FIFO unavailable for recorder ({str(e)}), trying nice")
+    try:
+        os.setpriority(os.PRIO_PROCESS, pid, -10)
+    except (AttributeError, OSError) as e:
+        print(f"Could not raise recorder priority: {str(e)}")
+
+# Helper: stop a child with SIGINT, escalating to SIGTERM then SIGKILL
+def terminate_process(proc) -> None:
+    try:
+        proc.send_signal(signal.SIGINT)
+        # A paused recorder only acts on SIGINT once continued
+        proc.send_signal(signal.SIGCONT)
+        proc.wait(timeout=1.0)
+        return
+    except subprocess.TimeoutExpired:
         pass
+    proc.terminate()
+    try:
+        proc.wait(timeout=0.5)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.wait()
 
-# Utility: list recordings
-def list_recordings():
+# Helper: stop whatever fed the player (sox process or feeder thread), if any;
+# call after the player itself has been stopped
+def stop_source() -> None:
+    source = task.source
+    if source:
+        try:
+            source.kill()
+            source.wait()
+        except Exception:
+            pass
+    task.source = None
+    feeder = task.feeder
+    if feeder:
+        # With the player gone its next write fails with EPIPE; it then closes its fd
+        feeder.join(timeout=1.0)
+    task.feeder = None
+
+# Helper: tell the kernel a recording is done with so its pages can be reclaimed
+def drop_page_cache(filepath: str) -> None:
+    try:
+        fd = os.open(filepath, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+# Helper: the request's JSON object, parsed once ({} if missing or not an object)
+def request_body() -> dict:
+    body = request.get_json(silent=True)
+    return body if isinstance(body, dict) else {}
+
+# Helper: accept only plain '.wav' names directly inside RECORDINGS_DIR
+def valid_recording_name(name) -> bool:
+    return (isinstance(name, str) and name.endswith('.wav') and not name.startswith('.')
+            and '/' not in name and '\\' not in name and '\0' not in name)
+
+# Open a recording by name, yields (fd, filepath); raises FileNotFoundError.
+# Callers reuse the one descriptor instead of checking exists() and reopening
+@contextlib.contextmanager
+def open_recording(filename: str):
+    filepath = os.path.join(app.config['RECORDINGS_DIR'], filename)
+    fd = os.open(filepath, os.O_RDONLY)
+    try:
+        yield fd, filepath
+    finally:
+        os.close(fd)
+
+# Helper: stop the current process and whatever feeds it, then reset 'task';
+# caller must hold 'lock'. Returns the mode that was stopped (None if idle)
+def stop_current_locked(drop_cache: bool = False):
+    proc = task.process
+    mode = task.mode
+    if proc:
+        terminate_process(proc)
+    stop_source()
+    
+    # Clean up temporary file if it exists
+    temp_file = task.temp_file
+    if temp_file and os.path.exists(temp_file):
+        try:
+            os.remove(temp_file)
+        except:
+            pass
+    
+    # Only a final stop drops the pages; replay/seek is about to read them again
+    if drop_cache and task.play_file:
+        drop_page_cache(task.play_file)
+    task.process = None
+    task.mode = None
+    task.temp_file = None
+    task.play_file = None
+    return mode
+
+# Helper: locate the 'data' chunk of a RIFF/WAVE file object, returns (offset, size)
+def find_data_chunk(f):
+    f.seek(0)
+    riff, _, wave_id = struct.unpack('<4sI4s', f.read(12))
+    if riff != b'RIFF' or wave_id != b'WAVE':
+        raise ValueError('Not a RIFF/WAVE file')
+    while True:
+        header = f.read(8)
+        if len(header) < 8:
+            raise ValueError('No data chunk found')
+        chunk_id, chunk_size = struct.unpack('<4sI', header)
+        if chunk_id == b'data':
+            return f.tell(), chunk_size
+        # Chunks are word aligned
+        f.seek(chunk_size + (chunk_size & 1), os.SEEK_CUR)
+
+# Helper: build a canonical 44-byte PCM WAV header
+def wav_header(channels: int, rate: int, sampwidth: int, data_size: int) -> bytes:
+    block_align = channels * sampwidth
+    data_size = min(data_size, 0xFFFFFFFF - 36)
+    return struct.pack(
+        '<4sI4s4sIHHIIHH4sI',
+        b'RIFF', 36 + data_size, b'WAVE',
+        b'fmt ', 16, 1, channels, rate, rate * block_align, block_align, sampwidth * 8,
+        b'data', data_size
+    )
+
+# Helper: write header + file range into a player's stdin (runs in a thread);
+# takes ownership of 'fd'
+def feed_player(proc, header: bytes, fd: int, offset: int, count: int) -> None:
+    try:
+        # Sequential hint widens readahead for the sendfile() reads below
+        os.posix_fadvise(fd, offset, count, os.POSIX_FADV_SEQUENTIAL)
+        proc.stdin.write(header)
+        proc.stdin.flush()
+        out_fd = proc.stdin.fileno()
+        while count > 0:
+            sent = os.sendfile(out_fd, fd, offset, count)
+            if sent == 0:
+                break
+            offset += sent
+            count -= sent
+    except (BrokenPipeError, OSError):
+        # Player was stopped or exited; nothing left to feed
+        pass
+    finally:
+        os.close(fd)
+        try:
+            proc.stdin.close()
+        except OSError:
+            pass
+
+# Cache of parsed WAV metadata: filepath -> ((mtime_ns, size), meta)
+wav_meta_cache = {}
+
+# Helper: parse a PCM WAV's fmt/data chunks from a single pread of its head,
+# returns None for anything else (caller falls back to the wave module)
+def read_wav_header(fd: int, file_size: int):
+    buf = os.pread(fd, 4096, 0)
+    if len(buf) < 12 or buf[0:4] != b'RIFF' or buf[8:12] != b'WAVE':
+        return None
+    fmt = None
+    pos = 12
+    while pos + 8 <= len(buf):
+        chunk_id, chunk_size = struct.unpack_from('<4sI', buf, pos)
+        pos += 8
+        if chunk_id == b'fmt ' and chunk_size >= 16 and pos + 16 <= len(buf):
+            fmt = struct.unpack_from('<HHIIHH', buf, pos)
+        elif chunk_id == b'data':
+            if fmt is None or fmt[0] != 1:  # WAVE_FORMAT_PCM only
+                return None
+            _, channels, rate, _, _, bits = fmt
+            sampwidth = (bits + 7) // 8
+            if not channels or not rate or not sampwidth:
+                return None
+            # A take still being recorded has a placeholder size; trust the file length
+            data_size = min(chunk_size, file_size - pos)
+            return {
+                'frames': data_size // (channels * sampwidth),
+                'rate': rate,
+                'channels': channels,
+                'sampwidth': sampwidth,
+                'data_offset': pos,
+                'data_size': data_size,
+            }
+        pos += chunk_size + (chunk_size & 1)
+    return None
+
+# Helper: WAV format/duration metadata, re-parsed only when the file changes
+def get_wav_meta(fd: int, filepath: str) -> dict:
+    st = os.fstat(fd)
+    stamp = (st.st_mtime_ns, st.st_size)
+    cached = wav_meta_cache.get(filepath)
+    if cached and cached[0] == stamp:
+        return cached[1]
+    meta = read_wav_header(fd, st.st_size)
+    if meta is None:
+        # Non-canonical file: let the wave module parse it
+        with open(fd, 'rb', closefd=False) as f:
+            with contextlib.closing(wave.open(f, 'rb')) as wf:
+                meta = {
+                    'frames': wf.getnframes(),
+                    'rate': wf.getframerate(),
+                    'channels': wf.getnchannels(),
+                    'sampwidth': wf.getsampwidth(),
+                }
+            meta['data_offset'], meta['data_size'] = find_data_chunk(f)
+    wav_meta_cache[filepath] = (stamp, meta)
+    return meta
+
+# Sorted cache of recording names, kept current by an inotify watcher thread
+recordings_cache = {
+    'files': [],
+    'names': set(),
+    'watching': False,  # False -> fall back to scanning the directory
+}
+recordings_lock = Lock()
+
+# Rendered index page as (recordings tuple, html) for the last seen listing
+index_cache = {'page': None}
+
+# inotify(7) constants
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+INOTIFY_EVENT = struct.Struct('iIII')  # wd, mask, cookie, len
+
+# Utility: scan the recordings directory
+def scan_recordings():
     files = [f for f in os.listdir(app.config['RECORDINGS_DIR']) if f.endswith('.wav')]
     files.sort()
     return files
 
+# Helper: replace the cached listing wholesale
+def reset_recordings_cache(files, watching: bool) -> None:
+    with recordings_lock:
+        recordings_cache['files'] = files
+        recordings_cache['names'] = set(files)
+        recordings_cache['watching'] = watching
+        index_cache['page'] = None
+
+# Helper: apply a single inotify event to the cached listing
+def apply_recordings_event(mask: int, name: str) -> None:
+    if mask & IN_ISDIR or not name.endswith('.wav'):
+        return
+    with recordings_lock:
+        files = recordings_cache['files']
+        names = recordings_cache['names']
+        if mask & (IN_CREATE | IN_MOVED_TO):
+            if name not in names:
+                names.add(name)
+                bisect.insort(files, name)
+        elif mask & (IN_DELETE | IN_MOVED_FROM):
+            if name in names:
+                names.discard(name)
+                del files[bisect.bisect_left(files, name)]
+        index_cache['page'] = None
+
+# Helper: read loop of the watcher thread
+def watch_recordings(fd: int) -> None:
+    try:
+        while True:
+            buf = os.read(fd, 64 * 1024)
+            pos = 0
+            while pos < len(buf):
+                _, mask, _, name_len = INOTIFY_EVENT.unpack_from(buf, pos)
+                pos += INOTIFY_EVENT.size
+                name = buf[pos:pos + name_len].rstrip(b'\0').decode(errors='surrogateescape')
+                pos += name_len
+                if mask & IN_Q_OVERFLOW:
+                    reset_recordings_cache(scan_recordings(), True)
+                elif mask & IN_IGNORED:
+                    # Watched directory went away (e.g. SSD unmounted)
+                    raise OSError('Recordings directory watch removed')
+                else:
+                    apply_recordings_event(mask, name)
+    except Exception as e:
+        print(f"Recordings watcher stopped, falling back to directory scans: {str(e)}")
+        with recordings_lock:
+            recordings_cache['watching'] = False
+    finally:
+        os.close(fd)
+
+# Start watching the recordings directory; best-effort, Linux only
+def start_recordings_watcher() -> None:
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        fd = libc.inotify_init1(os.O_CLOEXEC)
+        if fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        mask = IN_CREATE | IN_DELETE | IN_MOVED_TO | IN_MOVED_FROM
+        wd = libc.inotify_add_watch(fd, os.fsencode(app.config['RECORDINGS_DIR']), mask)
+        if wd < 0:
+            err = ctypes.get_errno()
+            os.close(fd)
+            raise OSError(err, 'inotify_add_watch failed')
+    except Exception as e:
+        print(f"inotify unavailable, recordings will be listed on each request: {str(e)}")
+        return
+    # Scan after the watch is in place so no file created in between is missed
+    reset_recordings_cache(scan_recordings(), True)
+    Thread(target=watch_recordings, args=(fd,), daemon=True).start()
+
+# Utility: list recordings
+def list_recordings():
+    with recordings_lock:
+        if recordings_cache['watching']:
+            return list(recordings_cache['files'])
+    return scan_recordings()
+
+start_recordings_watcher()
+
 @app.route('/')
 def index():
     recordings = list_recordings()
-    return render_template('index.html', recordings=recordings)
+    key = tuple(recordings)
+    page = index_cache['page']
+    if page and page[0] == key:
+        html = page[1]
+    else:
+        html = render_template('index.html', recordings=recordings)
+        index_cache['page'] = (key, html)
+    return Response(html, mimetype='text/html')
 
 @app.route('/record', methods=['POST'])
 def start_record():
     with lock:
         # Stop any existing process before starting record
-        if task['process']:
-            proc = task['process']
-            proc.send_signal(signal.SIGINT)
-            proc.wait()
-            task['process'] = None
-            task['mode'] = None
-        filename = request.json.get('filename') or ''
-        device = request.json.get('device', 'xr18')  # Default to xr18 if not specified
+        stop_current_locked()
+        body = request_body()
+        filename = body.get('filename') or ''
+        device = body.get('device', 'xr18')  # Default to xr18 if not specified
         
+        if not isinstance(filename, str):
+            return jsonify(status='error', message='Invalid file name'), 400
         if not filename:
             from datetime import datetime
             timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
@@ -71,201 +463,187 @@ def start_record():
             # Add .wav if no extension is provided
             if '.' not in filename:
                 filename += '.wav'
+        if not valid_recording_name(filename):
+            return jsonify(status='error', message='Invalid file name'), 400
         filepath = os.path.join(app.config['RECORDINGS_DIR'], filename)
         
         # Choose command based on device selection
-        if device == 'xr18':
-            cmd = [
-                'arecord',
-                '-D', 'hw:3,0',
-                '-f', 'S32_LE',
-                '-c', '18',
-                '-r', '48000',
-                filepath
-            ]
-        elif device == 'x32':
-            cmd = [
-                'arecord',
-                '-D', 'hw:3,0',
-                '-f', 'S32_LE',
-                '-c', '32',
-                '-r', '48000',
-                filepath
-            ]
-        else:
+        base = RECORD_CMDS.get(device) if isinstance(device, str) else None
+        if base is None:
             return jsonify(status='error', message='Invalid device selection'), 400
+        cmd = [*base, filepath]
             
         proc = subprocess.Popen(cmd, shell=False)
-        task['process'] = proc
-        task['mode'] = 'record'
+        # Set from here rather than preexec_fn, which isn't safe in a threaded server
+        raise_priority(proc.pid)
+        task.process = proc
+        task.mode = 'record'
         return jsonify(status='recording', file=filename)
 
 @app.route('/pause', methods=['POST'])
 def pause_record():
     with lock:
-        proc = task.get('process')
-        if not proc or task.get('mode') != 'record':
+        proc = task.process
+        if not proc or task.mode != 'record':
             return jsonify(status='error', message='Not recording'), 400
         # SIGSTOP to pause
         proc.send_signal(signal.SIGSTOP)
-        task['mode'] = 'paused'
+        task.mode = 'paused'
         return jsonify(status='paused')
 
 @app.route('/resume', methods=['POST'])
 def resume_record():
     with lock:
-        proc = task.get('process')
-        if not proc or task.get('mode') != 'paused':
+        proc = task.process
+        if not proc or task.mode != 'paused':
             return jsonify(status='error', message='Not paused'), 400
         proc.send_signal(signal.SIGCONT)
-        task['mode'] = 'record'
+        task.mode = 'record'
         return jsonify(status='recording')
 
 @app.route('/stop', methods=['POST'])
 def stop_task():
     with lock:
-        proc = task.get('process')
-        if not proc:
+        if not task.process:
             return jsonify(status='error', message='Nothing to stop'), 400
-        proc.send_signal(signal.SIGINT)
-        proc.wait()
-        mode = task['mode']
+        mode = stop_current_locked(drop_cache=True)
+        return jsonify(status='stopped', mode=mode)
+
+# Helper: start playing a recording; caller must hold 'lock'
+def start_play_locked(filename, device):
+    # Stop any existing process before starting play
+    stop_current_locked()
+    
+    if not filename:
+        return jsonify(status='error', message='No file selected'), 400
+    if not valid_recording_name(filename):
+        return jsonify(status='error', message='Invalid file name'), 400
         
-        # Clean up temporary file if it exists
-        temp_file = task.get('temp_file')
-        if temp_file and os.path.exists(temp_file):
-            try:
-                os.remove(temp_file)
-            except:
-                pass
+    # Choose command based on device selection
+    base = PLAY_CMDS.get(device) if isinstance(device, str) else None
+    if base is None:
+        return jsonify(status='error', message='Invalid device selection'), 400
+    cmd = [*base, '-']
         
-        task['process'] = None
-        task['mode'] = None
-        task['temp_file'] = None
-        return jsonify(status='stopped', mode=mode)
+    # aplay reads the file through our descriptor on stdin, so the
+    # sequential-access hint applies to the reads it actually does
+    try:
+        with open_recording(filename) as (fd, filepath):
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            proc = subprocess.Popen(cmd, stdin=fd)
+    except FileNotFoundError:
+        return jsonify(status='error', message='File not found'), 404
+    task.process = proc
+    task.mode = 'play'
+    task.play_file = filepath
+    return jsonify(status='playing', file=filename)
 
 @app.route('/play', methods=['POST'])
 def start_play():
     with lock:
-        # Stop any existing process before starting play
-        if task['process']:
-            proc = task['process']
-            proc.send_signal(signal.SIGINT)
-            proc.wait()
-            task['process'] = None
-            task['mode'] = None
-        filename = request.json.get('filename')
-        device = request.json.get('device', 'xr18')  # Default to xr18 if not specified
-        
-        if not filename:
-            return jsonify(status='error', message='No file selected'), 400
-        filepath = os.path.join(app.config['RECORDINGS_DIR'], filename)
-        if not os.path.exists(filepath):
-            return jsonify(status='error', message='File not found'), 404
-            
-        # Choose command based on device selection
-        if device == 'xr18':
-            cmd = ['aplay', '-D', 'hw:3,0', filepath]
-        elif device == 'x32':
-            cmd = ['aplay', '-D', 'hw:XUSB,0', '-c', '32', '-r', '48000', '-f', 'S32_LE', filepath]
-        else:
-            return jsonify(status='error', message='Invalid device selection'), 400
-            
-        proc = subprocess.Popen(cmd)
-        task['process'] = proc
-        task['mode'] = 'play'
-        return jsonify(status='playing', file=filename)
+        body = request_body()
+        filename = body.get('filename')
+        device = body.get('device', 'xr18')  # Default to xr18 if not specified
+        return start_play_locked(filename, device)
 
 @app.route('/next', methods=['POST'])
 def next_file():
     recordings = list_recordings()
-    current = request.json.get('current')
-    if current not in recordings:
+    current = request_body().get('current')
+    # Listing is sorted, so locate the current file by binary search
+    idx = bisect.bisect_left(recordings, current) if isinstance(current, str) else len(recordings)
+    if idx == len(recordings) or recordings[idx] != current:
         return jsonify(status='error', message='Invalid current file'), 400
-    idx = recordings.index(current)
-    nxt = recordings[(idx + 1) % len(recordings)] if recordings else None
+    nxt = recordings[(idx + 1) % len(recordings)]
     return jsonify(status='ok', next=nxt)
 
 @app.route('/rewind', methods=['POST'])
 def rewind():
-    # Stop and re-play from start
+    # Stop and re-play from start; start_play_locked stops the current
+    # player itself, so this stays within a single hold of the lock
     with lock:
-        # implement by stopping and starting same file
-        current = request.json.get('current')
-        # reuse stop and play
-        stop_task()
-        request.json['filename'] = current
-        return start_play()
+        body = request_body()
+        current = body.get('current')
+        device = body.get('device', 'xr18')
+        return start_play_locked(current, device)
 
 @app.route('/recordings/<path:filename>')
 def download_recording(filename):
     # Serve .wav files from the recordings directory
+    if not valid_recording_name(filename):
+        return jsonify({'error': 'Invalid file name'}), 400
+    prefix = app.config['ACCEL_REDIRECT_PREFIX']
+    if prefix:
+        # nginx copies the file to the socket itself, zero-copy
+        resp = Response(mimetype='audio/wav')
+        resp.headers['X-Accel-Redirect'] = prefix.rstrip('/') + '/' + quote(filename)
+        return resp
     return send_from_directory(app.config['RECORDINGS_DIR'], filename)
 
 @app.route('/duration/<filename>')
 def get_duration(filename):
-    filepath = os.path.join(app.config['RECORDINGS_DIR'], filename)
-    if not os.path.exists(filepath):
-        return jsonify({'error': 'File not found'}), 404
+    if not valid_recording_name(filename):
+        return jsonify({'error': 'Invalid file name'}), 400
     try:
-        with contextlib.closing(wave.open(filepath, 'rb')) as wf:
-            frames = wf.getnframes()
-            rate = wf.getframerate()
-            duration = frames / float(rate)
+        with open_recording(filename) as (fd, filepath):
+            meta = get_wav_meta(fd, filepath)
+        duration = meta['frames'] / float(meta['rate'])
         return jsonify({'duration': duration})
+    except FileNotFoundError:
+        return jsonify({'error': 'File not found'}), 404
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 @app.route('/seek', methods=['POST'])
 def seek_position():
-    with lock:
-        proc = task.get('process')
-        
-        filename = request.json.get('filename')
-        position = request.json.get('position', 0)
-        device = request.json.get('device', 'xr18')
+    with lock, contextlib.ExitStack() as stack:
+        body = request_body()
+        filename = body.get('filename')
+        position = body.get('position', 0)
+        device = body.get('device', 'xr18')
         
         if not filename:
             return jsonify(status='error', message='No file specified'), 400
+        if not valid_recording_name(filename):
+            return jsonify(status='error', message='Invalid file name'), 400
+        try:
+            position = float(position)
+        except (TypeError, ValueError):
+            position = math.nan
+        if not math.isfinite(position) or position < 0:
+            return jsonify(status='error', message='Invalid position'), 400
             
-        filepath = os.path.join(app.config['RECORDINGS_DIR'], filename)
-        if not os.path.exists(filepath):
+        try:
+            # Held open for the whole seek; each attempt's feeder gets a dup
+            fd, filepath = stack.enter_context(open_recording(filename))
+        except FileNotFoundError:
             return jsonify(status='error', message='File not found'), 404
         
         # If something is playing, stop it first
-        if proc:
-            try:
-                proc.send_signal(signal.SIGINT)
-                proc.wait(timeout=2)
-            except subprocess.TimeoutExpired:
-                proc.kill()
-                proc.wait()
-            except:
-                pass
+        stop_current_locked()
         
-        # Small delay to ensure audio device is released
-        time.sleep(0.15)
-        # Proactively kill any stray aplay still holding the device
-        force_release_device(device)
-        
-        # Use sox piping to aplay to avoid temp files and reduce latency
+        # Stream the WAV header plus a byte-aligned tail of the data chunk straight
+        # into aplay; no decoding needed since recordings are plain PCM
+        header = None
         try:
-            if device == 'xr18':
-                # Pipe trimmed audio directly into aplay on XR18
-                cmd = ['bash', '-c', f'sox -V1 -q "{filepath}" -t wav - trim {position} | aplay -D hw:3,0 -']
-            elif device == 'x32':
-                # Pipe trimmed audio directly into aplay with explicit format for X32
-                cmd = ['bash', '-c', f'sox -V1 -q "{filepath}" -t wav - trim {position} | aplay -D hw:XUSB,0 -c 32 -r 48000 -f S32_LE -']
-            else:
-                return jsonify(status='error', message='Invalid device selection'), 400
+            meta = get_wav_meta(fd, filepath)
+            rate = meta['rate']
+            channels = meta['channels']
+            sampwidth = meta['sampwidth']
+            data_start, data_size = meta['data_offset'], meta['data_size']
+            block_align = channels * sampwidth
+            byte_offset = min(max(0, int(position * rate)) * block_align, data_size - data_size % block_align)
+            remaining = data_size - byte_offset
+            header = wav_header(channels, rate, sampwidth, remaining)
         except Exception as e:
-            # Fallback: restart from beginning if sox fails to construct
-            if device == 'xr18':
-                cmd = ['aplay', '-D', 'hw:3,0', filepath]
-            elif device == 'x32':
-                cmd = ['aplay', '-D', 'hw:XUSB,0', '-c', '32', '-r', '48000', '-f', 'S32_LE', filepath]
-            else:
-                return jsonify(status='error', message='Invalid device selection'), 400
+            print(f"Byte-offset seek unavailable, falling back to sox: {str(e)}")
+
+        base = PLAY_CMDS.get(device) if isinstance(device, str) else None
+        if base is None:
+            return jsonify(status='error', message='Invalid device selection'), 400
+        cmd = [*base, '-']
+        # Non-canonical WAV: trim through sox, piped into aplay without a shell
+        sox_cmd = None if header is not None else ['sox', '-V1', '-q', filepath, '-t', 'wav', '-', 'trim', str(position)]
         
         # Try to start the new process with retry mechanism
         max_retries = 3
@@ -273,24 +651,67 @@ def seek_position():
             try:
                 # Add some debugging
                 print(f"Seek command (attempt {attempt + 1}): {' '.join(cmd)}")
+                if sox_cmd:
+                    print(f"Fed by: {' '.join(sox_cmd)}")
                 print(f"Seeking to position: {position} seconds")
                 
-                # Ensure device is free before each attempt
-                force_release_device(device)
+                # Wait until the audio device is actually released; a timeout is a failed attempt
+                if not wait_device_free(device, timeout=1.0 if attempt == 0 else 0.5):
+                    print(f"Audio device still in use, attempt {attempt + 1}")
+                    if attempt < max_retries - 1:
+                        continue
+                    # Our own player is already stopped, so something else holds the device
+                    return jsonify(status='error', message='Audio device in use by another program'), 500
                 
-                proc = subprocess.Popen(cmd, shell=False)
+                source = None
+                feeder = None
+                if sox_cmd is None:
+                    proc = subprocess.Popen(cmd, stdin=subprocess.PIPE)
+                    feed_fd = None
+                    try:
+                        feed_fd = os.dup(fd)
+                        # The kernel copies page cache -> pipe; Python only loops on sendfile()
+                        feeder = Thread(target=feed_player,
+                                        args=(proc, header, feed_fd, data_start + byte_offset, remaining),
+                                        daemon=True)
+                        feeder.start()
+                    except Exception:
+                        # Don't leave an unfed aplay holding the device for the retry
+                        if feed_fd is not None:
+                            os.close(feed_fd)
+                        proc.kill()
+                        proc.stdin.close()
+                        proc.wait()
+                        raise
+                else:
+                    source = subprocess.Popen(sox_cmd, stdout=subprocess.PIPE)
+                    try:
+                        proc = subprocess.Popen(cmd, stdin=source.stdout)
+                    except Exception:
+                        source.kill()
+                        source.wait()
+                        raise
+                    finally:
+                        # aplay holds its own copy of the read end
+                        source.stdout.close()
                 
-                # Give it a moment to start and check if it's still running
-                time.sleep(0.2)
-                if proc.poll() is None:  # Process is still running
-                    task['process'] = proc
-                    task['mode'] = 'play'
+                # Only count the attempt once aplay has set up the device and is still running
+                if wait_player_started(proc, device):
+                    task.process = proc
+                    task.source = source
+                    task.feeder = feeder
+                    task.mode = 'play'
+                    task.play_file = filepath
                     return jsonify(status='seeking', position=position, file=filename)
                 else:
+                    if source:
+                        source.kill()
+                        source.wait()
+                    if feeder:
+                        feeder.join(timeout=1.0)
                     # Process exited immediately, might be device busy
                     print(f"Process exited immediately, attempt {attempt + 1}")
                     if attempt < max_retries - 1:
-                        time.sleep(0.5)  # Wait longer before retry
                         continue
                     else:
                         return jsonify(status='error', message='Audio device busy, please try again'), 500
@@ -298,10 +719,11 @@ def seek_position():
             except Exception as e:
                 print(f"Seek attempt {attempt + 1} failed: {str(e)}")
                 if attempt < max_retries - 1:
-                    time.sleep(0.5)
                     continue
                 else:
                     return jsonify(status='error', message=f'Seek failed after {max_retries} attempts: {str(e)}'), 500
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5000)
\ No newline at end of file
+    # Threaded so /duration polls and downloads don't queue behind control requests;
+    # 'lock' still serialises everything that touches 'task'
+    app.run(host='0.0.0.0', port=5000, threaded=True)
\ No newline at end of file